@@ -1,9 +1,13 @@
+import os
+import selectors
+import signal
+import threading
 from dataclasses import dataclass
+from functools import cached_property
 from ipaddress import IPv4Address, IPv4Network
 from logging import getLogger
 from pathlib import Path
-from time import sleep
-from typing import Optional, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 from autopxe.distributions import Distribution
 from autopxe.dnsmasq import DnsMasq
@@ -13,6 +17,9 @@ from autopxe.preseed import Preseeder
 
 LOG = getLogger(__name__)
 
+# Signals that make `Pxe.run` stop dnsmasq and clean up
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
 
 @dataclass
 class Pxe:
@@ -27,25 +34,89 @@ class Pxe:
     masquerade_iface: Interface
     # How many clients can get an address
     dhcp_range_size: int = 20
-    # Whether the process must stop
-    must_stop: bool = False
     # Optional preseed file
     preseed_file: Optional[Path] = None
 
+    def __post_init__(self):
+        # Whether the process must stop, see `must_stop`
+        self._must_stop = False
+        # Write end of the pipe that wakes `run` up when asked to stop
+        self._stop_pipe: Optional[int] = None
+        # Keeps the pipe from being closed while it's written to. Reentrant since
+        # a signal handler can interrupt the main thread while it holds it.
+        self._stop_lock = threading.RLock()
+
     @property
+    def must_stop(self) -> bool:
+        """Whether the process must stop. Setting it wakes `run` up, from any thread."""
+        return self._must_stop
+
+    @must_stop.setter
+    def must_stop(self, value: bool):
+        self._must_stop = value
+        with self._stop_lock:
+            if value and self._stop_pipe is not None:
+                os.write(self._stop_pipe, b"\0")
+
+    @cached_property
     def server_address(self) -> IPv4Address:
         """The server (our) address, which is the first address on the network"""
         return next(self.pxe_net.hosts())
 
-    @property
+    @cached_property
     def dhcp_range(self) -> Tuple[IPv4Address, IPv4Address]:
         """Lower and upper (inclusive) bounds for the DHCP client range"""
         return (first_addr := self.server_address + 1), first_addr + self.dhcp_range_size
 
+    def stop(self):
+        """Makes `run` stop dnsmasq and return. Can be called from another thread."""
+        self.must_stop = True
+
+    def _handle_stop_signals(self) -> Dict[int, Any]:
+        """Makes the stop signals call `stop` and returns the previous handlers.
+
+        Signal handlers can only be set from the main thread, so this does nothing elsewhere.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+        return {signum: signal.signal(signum, lambda *_: self.stop()) for signum in STOP_SIGNALS}
+
+    def supervise(self, dnsmasq: DnsMasq):
+        """Logs dnsmasq output until it exits or we're asked to stop.
+
+        Sleeps until there is something to do instead of polling.
+        """
+        assert dnsmasq.process
+        stop_read, stop_write = os.pipe()
+        with self._stop_lock:
+            self._stop_pipe = stop_write
+        previous_handlers = self._handle_stop_signals()
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(dnsmasq, selectors.EVENT_READ)
+                selector.register(stop_read, selectors.EVENT_READ)
+                while dnsmasq.running and not self.must_stop:
+                    for key, _ in selector.select():
+                        if key.fileobj is dnsmasq and not dnsmasq.read_logs():
+                            # dnsmasq closed its output, it's exiting
+                            selector.unregister(dnsmasq)
+                            dnsmasq.process.wait()
+        finally:
+            try:
+                # Our handlers are still set, so that a stop signal doesn't interrupt this
+                dnsmasq.stop()
+            finally:
+                with self._stop_lock:
+                    self._stop_pipe = None
+                    os.close(stop_write)
+                os.close(stop_read)
+                for signum, handler in previous_handlers.items():
+                    signal.signal(signum, handler)
+
     def run(self):
-        with (self.distribution.unpack() as tempdir,
+        with (self.distribution.unpack() as netboot_dir,
               setup_iface(self.server_address, self.pxe_net.prefixlen, self.pxe_iface),
-              masquerade(),
+              masquerade(self.masquerade_iface),
               # FIXME: preseed is not mandatory, actually
               Preseeder(file_path=self.preseed_file, server_ip=self.server_address) as preseeder,
               ):
@@ -56,21 +127,13 @@ class Pxe:
             if self.preseed_file:
                 # serve the preseed file to the client if it's the debian installer
                 dhcp_boot.append(("tag:installer", preseeder.url))
-            with DnsMasq(tftp_root=tempdir,
+            with DnsMasq(tftp_root=netboot_dir,
                          interface=self.pxe_iface.name,
                          dhcp_boot=dhcp_boot,
                          dhcp_range=(*self.dhcp_range, "1h"),
                          listen_address=self.server_address,
                          ) as dnsmasq:
-                try:
-                    while dnsmasq.running:
-                        dnsmasq.read_logs()
-                        sleep(.1)
-                        if self.must_stop:
-                            dnsmasq.stop()
-                            break
-                except KeyboardInterrupt:
-                    dnsmasq.stop()
+                self.supervise(dnsmasq)
                 # Read the last logs
-                dnsmasq.read_logs()
+                dnsmasq.read_remaining_logs()
             LOG.info("dnsmasq exited with status %d", dnsmasq.process.poll())
@@ -1,18 +1,29 @@
 
+import os
+import shutil
 import tarfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from configparser import ConfigParser
 from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import cached_property, lru_cache
 from hashlib import blake2s
 from logging import getLogger
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from typing import Dict, Iterator
+from typing import Dict, Iterator, List
 from urllib.parse import urlparse
-from urllib.request import urlretrieve
+from urllib.request import urlopen
+from zlib import crc32
 
 LOG = getLogger(__name__)
 
+# How much is downloaded at a time, a progress dot is printed for each chunk
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# How many threads write extracted files to disk
+EXTRACT_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+# Created in the unpacked archive directory once the extraction is complete
+UNPACKED_SENTINEL = ".ok"
+
 
 @dataclass(frozen=True)
 class Distribution:
@@ -22,57 +33,172 @@ class Distribution:
     # The URL at which the netboot.tar.gz archive for this distribution can be retrieved
     url: str
 
-    @property
+    @cached_property
     def filename(self) -> str:
         """The filename as guessed from the URL"""
         parsed = urlparse(self.url)
         return parsed.path.rsplit("/", 1)[-1]
 
-    @property
+    @cached_property
     def url_hash(self) -> str:
-        """A hash of the url, for caching purposes."""
-        # TODO blake2s is probably not ideal
-        return blake2s(self.url.encode()).hexdigest()
+        """A hash of the url, for caching purposes. It doesn't need to be cryptographic."""
+        return f"{crc32(self.url.encode()):08x}"
+
+    @cached_property
+    def cache_dir(self) -> Path:
+        """Where the archive and its unpacked contents are cached"""
+        return Path.home().joinpath(".cache", "pxe", self.url_hash)
+
+    def download(self, path: Path):
+        """Downloads the netboot archive to the given path.
+
+        The download goes to a temporary file that is only renamed to `path` once complete,
+        so that an aborted download doesn't leave a truncated archive in the cache.
+        """
+        LOG.info("Downloading %s", self.url)
+        partial_path = path.with_name(f"{path.name}.part")
+        try:
+            with urlopen(self.url) as response, partial_path.open("wb") as partial:
+                while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                    partial.write(chunk)
+                    print(end=".", flush=True)
+            print()
+            partial_path.replace(path)
+        finally:
+            partial_path.unlink(missing_ok=True)
 
     @contextmanager
     def get_archive(self) -> Iterator[tarfile.TarFile]:
         """Downloads (or gets from cache) the netboot tar archive and opens it."""
         # FIXME only works for tar files
         # Where the archive is cached to avoid redownloading it
-        cached_path = Path.home().joinpath(".cache", "pxe", self.url_hash, self.filename)
-        if not cached_path.parent.exists():
-            LOG.debug("Creating %s", cached_path.parent)
-            cached_path.parent.mkdir(exist_ok=True, parents=True)
+        cached_path = self.cache_dir / self.filename
+        # Archives used to be cached in a directory named after the blake2s of the url
+        legacy_dir = self.cache_dir.with_name(blake2s(self.url.encode()).hexdigest())
+        if not self.cache_dir.exists() and legacy_dir.exists():
+            LOG.debug("Moving %s to %s", legacy_dir, self.cache_dir)
+            legacy_dir.rename(self.cache_dir)
+        if not self.cache_dir.exists():
+            LOG.debug("Creating %s", self.cache_dir)
+            self.cache_dir.mkdir(exist_ok=True, parents=True)
         if not cached_path.exists():
-            LOG.info("Downloading %s", self.url)
-
-            def report_cb(blocks: int, block_size: int, total_size: int):
-                print(end=".", flush=True)
-            # TODO does not cleanup if aborted
-            urlretrieve(self.url, cached_path, reporthook=report_cb)
-            print()
+            self.download(cached_path)
         LOG.debug("Opening %s", cached_path)
         with tarfile.open(cached_path) as tar:
-            # TODO check tar contents
-            # FIXME gaping security hole esp since run as root
+            # The members are checked when extracted, see extract()
             yield tar
 
     @contextmanager
     def unpack(self) -> Iterator[Path]:
-        """Unpacks the netboot archive to a temporary directory,
-        cleaned when the context manager exits"""
-        with TemporaryDirectory("pxe") as td:
+        """Unpacks the netboot archive next to it in the cache, unless that's already done,
+        and returns the directory it's unpacked to.
+
+        The archive contents never change for a given url, so they're only extracted once.
+        """
+        unpacked = self.cache_dir / "unpacked"
+        if (unpacked / UNPACKED_SENTINEL).exists():
+            LOG.debug("%s is already extracted to %s", self.name, unpacked)
+        else:
             with self.get_archive() as tar:
-                LOG.info("Extracting %s to %s", self.name, td)
-                tar.extractall(path=td)
-            yield Path(td)
+                # Extract elsewhere first so that an interrupted extraction isn't used
+                partial = unpacked.with_name(f"{unpacked.name}.partial")
+                for leftover in (partial, unpacked):
+                    if leftover.exists():
+                        shutil.rmtree(leftover)
+                LOG.info("Extracting %s to %s", self.name, unpacked)
+                extract(tar, partial)
+                (partial / UNPACKED_SENTINEL).touch()
+                partial.rename(unpacked)
+        yield unpacked
+
+
+def _check_member(member: tarfile.TarInfo, path: Path) -> tarfile.TarInfo:
+    """Returns the member to extract, raises if it would be written outside of `path`.
+
+    That's tarfile's "data" extraction filter where it exists (3.12, and backported to
+    3.10.12 and 3.11.4). Elsewhere, only the destination and link targets are checked.
+    """
+    if data_filter := getattr(tarfile, "data_filter", None):
+        return data_filter(member, str(path))
+    root = path.resolve()
+    targets = [root / member.name]
+    if member.issym():
+        targets.append(targets[0].parent / member.linkname)
+    elif member.islnk():
+        targets.append(root / member.linkname)
+    for target in targets:
+        if not target.resolve().is_relative_to(root):
+            raise tarfile.ExtractError(f"{member.name}: would be extracted outside of {path}")
+    return member
+
+
+def _write_file(tar: tarfile.TarFile, member: tarfile.TarInfo, data: bytes, target: Path):
+    """Writes an extracted regular file and sets its attributes like tarfile would"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.write_bytes(data)
+    tar.chown(member, str(target), False)
+    tar.chmod(member, str(target))
+    tar.utime(member, str(target))
+
+
+def extract(tar: tarfile.TarFile, path: Path):
+    """Extracts all the archive's members to the given directory.
+
+    Like `TarFile.extractall` but the regular files, which netboot archives have a lot
+    of, are written by a thread pool. The archive itself is still read sequentially
+    since it is compressed, extracting members from several handles would mean
+    decompressing it once per handle.
+
+    Members that would end up outside of `path` raise a `tarfile.TarError`.
+    """
+    if data_filter := getattr(tarfile, "data_filter", None):
+        # Used by tar.extract() below, the regular files don't go through it
+        tar.extraction_filter = data_filter
+    directories: List[tarfile.TarInfo] = []
+    links: List[tarfile.TarInfo] = []
+    writes: List[Future] = []
+    with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as pool:
+        for member in tar:
+            member = _check_member(member, path)
+            if member.isreg():
+                source = tar.extractfile(member)
+                assert source
+                writes.append(pool.submit(_write_file, tar, member, source.read(),
+                                          path / member.name))
+            elif member.isdir():
+                # Attributes are set at the end, like extractall does
+                tar.extract(member, path, set_attrs=False)
+                directories.append(member)
+            else:
+                # Hard links need their target to be written first
+                links.append(member)
+    # Raise write errors, if any
+    for write in writes:
+        write.result()
+    for member in links:
+        tar.extract(member, path)
+    for member in reversed(directories):
+        target = str(path / member.name)
+        tar.chown(member, target, False)
+        tar.chmod(member, target)
+        tar.utime(member, target)
 
 
 def from_file(path: Path) -> Dict[str, Distribution]:
-    """Reads distributions from the given file"""
-    assert path.exists()
+    """Reads distributions from the given file.
+
+    The file is only parsed again if it was modified since the last call.
+    """
+    return dict(_parse_file(path, path.stat().st_mtime_ns))
+
+
+@lru_cache(maxsize=4)
+def _parse_file(path: Path, mtime_ns: int) -> Dict[str, Distribution]:
+    """Parses distributions from the given file. `mtime_ns` is only part of the cache key."""
     config = ConfigParser()
-    config.read("distros.ini")
+    # Unlike config.read(), this raises if the file can't be read
+    with path.open(encoding="utf-8") as config_file:
+        config.read_file(config_file)
     distros: Dict[str, Distribution] = {
         i: Distribution(name=i, **config[i]) for i in config.sections()
     }
@@ -1,17 +1,19 @@
 from __future__ import annotations
 
-import functools
+import os
 import subprocess
-import tempfile
-from dataclasses import asdict, dataclass
-from distutils.spawn import find_executable
+from dataclasses import dataclass, fields
 from logging import getLogger
-from pathlib import Path
-from typing import Any, Iterable, Optional, Protocol, TextIO
+from shutil import which
+from typing import (IO, Any, Callable, ClassVar, Iterable, Optional, Protocol,
+                    get_origin, get_type_hints)
 
 LOG = getLogger(__name__)
 
-if (DNSMASQ := find_executable("dnsmasq")) is None:
+# How much of dnsmasq's logs is read at a time
+LOG_READ_SIZE = 65536
+
+if (DNSMASQ := which("dnsmasq")) is None:
     raise RuntimeError("dnsmasq not in PATH")
 
 
@@ -40,18 +42,26 @@ class DnsMasq:
     tftp_no_blocksize: bool = True
     log_dhcp: bool = True
     dhcp_vendorclass: str = "set:installer,d-i"
+    # (field name, dnsmasq switch, formatter) for each option,
+    # computed once after the class is defined
+    _SCHEMA: ClassVar[tuple[tuple[str, str, Callable[[DnsMasq, Any, str], list[str]]], ...]]
 
     def __post_init__(self):
         self.process: Optional[subprocess.Popen] = None
-        self.workdir: Optional[tempfile.TemporaryDirectory] = None
-        self.logs: Optional[TextIO] = None
+        self.logs: Optional[IO[bytes]] = None
+        # Logs read from dnsmasq that don't make a full line yet
+        self.log_buffer = bytearray()
+        # The full dnsmasq commandline, built when entering the context manager
+        self.cmdline: tuple[str, ...] = ()
 
-    @functools.singledispatchmethod
     def format_option(self, value: Any, switch: str) -> list[str]:
+        """Format an option according to the type of its value."""
+        return self._FORMATTERS.get(type(value), DnsMasq._format_value)(self, value, switch)
+
+    def _format_value(self, value: Any, switch: str) -> list[str]:
         """Format a regular single value option."""
         return [f"{switch}={value}"]
 
-    @format_option.register
     def _format_bool(self, value: bool, switch: str) -> list[str]:
         """Format a boolean option.
 
@@ -60,47 +70,57 @@ class DnsMasq:
         """
         return [switch] if value else []
 
-    @format_option.register
     def _format_tuple(self, value: tuple, switch: str) -> list[str]:
         """Format a tuple of values. dnsmasq expects them joined with commas"""
         return [f"{switch}={','.join(map(str, value))}"]
 
-    @format_option.register
     def _format_list(self, value: list, switch: str) -> list[str]:
+        """Format a list of values. The switch is repeated for each of them"""
         options = []
         for i in value:
             options.extend(self.format_option(i, switch))
         return options
 
+    # Formatters for the types that aren't formatted as a single value
+    _FORMATTERS: ClassVar[dict[type, Callable[[DnsMasq, Any, str], list[str]]]] = {
+        bool: _format_bool,
+        tuple: _format_tuple,
+        list: _format_list,
+    }
+
     @property
     def formatted_options(self) -> Iterable[str]:
         """An iterator over the formatted options, ready to pass to dnsmasq"""
-        for name, value in asdict(self).items():
-            # we have underscores but dnsmasq takes dashes
-            yield from self.format_option(value, f"--{name.replace('_', '-')}")
+        # Not asdict(), which would deep copy every value for nothing
+        for name, switch, formatter in self._SCHEMA:
+            yield from formatter(self, getattr(self, name), switch)
 
     def __enter__(self) -> DnsMasq:
         """Launches the dnsmasq process and return its handle"""
         assert DNSMASQ
-        # Create the working directory
-        self.workdir = tempfile.TemporaryDirectory(prefix="autopxe-dnsmasq-")
-        # Override the "--log-facility" argument with our log file
-        self.log_facility = Path(self.workdir.name) / "dnsmasq.log"
-        # Dnsmasq needs it to exist
-        self.log_facility.touch()
-        cmdline = (DNSMASQ, "-C", "/dev/null", *self.formatted_options)
+        self.cmdline = cmdline = (DNSMASQ, "-C", "/dev/null", *self.formatted_options)
         LOG.info("running %s", " ".join(cmdline))
-        self.process = subprocess.Popen(cmdline, text=True)
+        # With "--log-facility=-" dnsmasq logs to stderr. Unlike a regular file,
+        # a pipe can be waited on with select() and signals EOF when dnsmasq exits.
+        # It doesn't need the other standard streams.
+        # In its own session it isn't signaled along with us on ^C, we stop it ourselves.
+        self.process = subprocess.Popen(cmdline,
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE,
+                                        bufsize=0,
+                                        start_new_session=True)
         LOG.info("dnsmasq started with pid %d", self.process.pid)
-        # Open the logfile
-        self.logs = self.log_facility.open(mode="rt")
+        self.logs = logs = self.process.stderr
+        assert logs
+        # Only read what's available, never wait for more
+        os.set_blocking(logs.fileno(), False)
         return self
 
     def __exit__(self, *args, **kwargs):
         """Stop dnsmasq"""
         self.stop()
         self.logs.close()
-        self.workdir.cleanup()
 
     def stop(self):
         """Stops and waits for the dnsmasq process if it's running"""
@@ -109,12 +129,79 @@ class DnsMasq:
             self.process.terminate()
             self.process.wait()
 
-    def read_logs(self):
-        """Reads the logfile and logs it with DEBUG level"""
-        for line in filter(None, map(str.strip, self.logs.readlines())):
-            LOG.info(line)
+    def read_logs(self) -> bool:
+        """Reads some of the available dnsmasq logs and logs them with INFO level.
+
+        At most `LOG_READ_SIZE` bytes are read, so that a chatty dnsmasq can't keep the
+        caller busy: the rest is read when the selector reports the pipe readable again.
+        Returns `False` once dnsmasq closed its end of the pipe.
+        """
+        try:
+            data = os.read(self.fileno(), LOG_READ_SIZE)
+        except BlockingIOError:
+            return True
+        return self._handle_logs(data)
+
+    def read_remaining_logs(self):
+        """Reads what's left of the logs once dnsmasq exited"""
+        while True:
+            try:
+                data = os.read(self.fileno(), LOG_READ_SIZE)
+            except BlockingIOError:
+                return
+            if not self._handle_logs(data):
+                return
+
+    def _handle_logs(self, data: bytes) -> bool:
+        """Logs the complete lines of `data`. Incomplete lines are kept until the rest is read.
+
+        Returns `False` if `data` is empty, meaning dnsmasq closed its end of the pipe.
+        """
+        if not data:
+            # Whatever is left won't be completed
+            self._log_line(self.log_buffer)
+            self.log_buffer.clear()
+            return False
+        self.log_buffer += data
+        *lines, self.log_buffer = self.log_buffer.split(b"\n")
+        for line in lines:
+            self._log_line(line)
+        return True
+
+    @staticmethod
+    def _log_line(line: bytes):
+        """Logs a line from dnsmasq, unless it's blank"""
+        if line := line.strip():
+            LOG.info(line.decode(errors="replace"))
+
+    def fileno(self) -> int:
+        """The file descriptor to read logs from, so that dnsmasq can be selected on"""
+        assert self.logs
+        return self.logs.fileno()
 
     @property
     def running(self) -> bool:
         """Whether the dnsmasq process is still running"""
         return self.process is not None and self.process.poll() is None
+
+
+def _pick_formatter(hint: Any) -> Callable[[DnsMasq, Any, str], list[str]]:
+    """Picks the formatter for an option from its field's resolved type hint.
+
+    Parametrized generics are looked up by their origin, e.g. `tuple` for `tuple[HasStr, ...]`.
+    """
+    return DnsMasq._FORMATTERS.get(get_origin(hint) or hint, DnsMasq._format_value)
+
+
+def _schema() -> tuple[tuple[str, str, Callable[[DnsMasq, Any, str], list[str]]], ...]:
+    """Builds `DnsMasq._SCHEMA`"""
+    # The annotations are strings, because of the __future__ import
+    hints = get_type_hints(DnsMasq)
+    return tuple(
+        # we have underscores but dnsmasq takes dashes
+        (field.name, f"--{field.name.replace('_', '-')}", _pick_formatter(hints[field.name]))
+        for field in fields(DnsMasq)
+    )
+
+
+DnsMasq._SCHEMA = _schema()
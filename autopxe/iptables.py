@@ -1,55 +1,52 @@
 """used to set up masquerading with iptables"""
 from contextlib import contextmanager
 from logging import getLogger
-from subprocess import check_call
+from subprocess import run
+from typing import Mapping, Sequence
 
-from autopxe.networking import get_default_iface
+from autopxe.networking import Interface
 
 LOG = getLogger(__name__)
 
 
+def iptables_restore(action: str, rules: Mapping[str, Sequence[str]]):
+    """Applies the given command to all the rules with a single iptables-restore call.
+
+    rules format is table_name = [rule, ...]
+    where each rule is an iptables rule specification, starting with the chain name.
+    All the rules are committed at once, so either all of them are applied or none is.
+    """
+    ruleset = "".join(
+        f"*{table}\n" + "".join(f"{action} {rule}\n" for rule in table_rules) + "COMMIT\n"
+        for table, table_rules in rules.items()
+    )
+    LOG.info("iptables-restore --noflush\n%s", ruleset.rstrip())
+    run(["iptables-restore", "--noflush"], input=ruleset, text=True, check=True)
+
+
 @contextmanager
-def call_iptables(**kwargs: str):
-    """Adds a rule to iptables and removes it.
-    Only append rules are supported.
+def iptables_rules(rules: Mapping[str, Sequence[str]]):
+    """Adds rules to iptables and removes them.
 
-    kwargs format is iptables_option = option_value
-    where iptables_option is a snake_cased iptable commandline option.
+    See `iptables_restore` for the rules format.
     """
-    assert "append" in kwargs, "non-append rules are not supported"
-    # Arguments for the call that adds the rule
-    iptables_add_args = ["iptables"]
-    # Add option and its value to the arguments
-    for key, value in kwargs.items():
-        iptables_add_args.extend((
-            "--" + key.replace("_", "-"), value
-        ))
-    # Arguments for the call that deletes the rule
-    iptables_del_args = iptables_add_args.copy()
-    # We just replace --append with --delete, that works for our needs
-    iptables_del_args[iptables_del_args.index("--append")] = "--delete"
+    iptables_restore("-A", rules)
     try:
-        LOG.info("%s", " ".join(iptables_add_args))
-        check_call(iptables_add_args)
         yield
     finally:
-        LOG.info("%s", " ".join(iptables_del_args))
-        check_call(iptables_del_args)
+        iptables_restore("-D", rules)
 
 
 @contextmanager
-def masquerade():
-    """Setups crude masquerading with iptables."""
-    iface = get_default_iface()
-    with (call_iptables(append="FORWARD",
-                        out_interface=iface.name,
-                        jump="ACCEPT"),
-          call_iptables(append="FORWARD",
-                        in_interface=iface.name,
-                        jump="ACCEPT"),
-          call_iptables(table="nat",
-                        append="POSTROUTING",
-                        out_interface=iface.name,
-                        jump="MASQUERADE"),
-          ):
+def masquerade(iface: Interface):
+    """Setups crude masquerading with iptables, on the interface with an internet connection."""
+    with iptables_rules({
+        "filter": [
+            f"FORWARD --out-interface {iface.name} --jump ACCEPT",
+            f"FORWARD --in-interface {iface.name} --jump ACCEPT",
+        ],
+        "nat": [
+            f"POSTROUTING --out-interface {iface.name} --jump MASQUERADE",
+        ],
+    }):
         yield
@@ -1,15 +1,19 @@
 """Networking stuff using the pyroute2 library"""
 from __future__ import annotations
 
+import atexit
 import errno
 from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import lru_cache
 from ipaddress import IPv4Address
+from itertools import islice
 from logging import getLogger
-from socket import AddressFamily
-from typing import Any, Iterator, List, Mapping, Optional
+from socket import SOL_SOCKET, AddressFamily, if_indextoname
+from typing import Any, Iterator, List, Mapping, Optional, Tuple
 
 from pyroute2 import IPRoute
+from pyroute2.arp import ARPHRD_ETHER
 from pyroute2.netlink.exceptions import NetlinkError
 from pyroute2.nftables import expressions
 from pyroute2.nftables.main import NFTables  # type: ignore
@@ -21,6 +25,44 @@ LOG = getLogger(__name__)
 NFPROTO_UNSPEC = 0
 NFPROTO_INET = 1
 NFPROTO_IPV4 = 2
+# linux/if.h, the maximum length of an interface name including the final NUL
+IFNAMSIZ = 16
+# asm-generic/socket.h, like SO_SNDBUF/SO_RCVBUF but not capped by net.core.[wr]mem_max
+SO_SNDBUFFORCE = 32
+SO_RCVBUFFORCE = 33
+# The netlink socket buffer sizes. That's what pyroute2 asks for already,
+# but without forcing it, which stock kernels cap to ~200KB.
+NETLINK_BUFFER_SIZE = 1024 * 1024
+
+
+# The netlink socket shared by the whole module, see _ipr()
+_IPROUTE: Optional[IPRoute] = None
+
+
+def _force_buffers(sock: Any) -> None:
+    """Gives a netlink socket its full buffers, so that bursts don't block or get dropped.
+
+    Forcing requires CAP_NET_ADMIN, without it the capped sizes stay.
+    """
+    try:
+        sock.setsockopt(SOL_SOCKET, SO_SNDBUFFORCE, NETLINK_BUFFER_SIZE)
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUFFORCE, NETLINK_BUFFER_SIZE)
+    except PermissionError:
+        LOG.debug("Can't force the netlink socket buffer sizes")
+
+
+@contextmanager
+def _ipr() -> Iterator[IPRoute]:
+    """Yields the module's netlink socket, opened on first use and closed at exit.
+
+    Sharing it avoids creating, binding and closing a socket for every lookup.
+    """
+    global _IPROUTE
+    if _IPROUTE is None:
+        _IPROUTE = IPRoute()
+        _force_buffers(_IPROUTE)
+        atexit.register(_IPROUTE.close)
+    yield _IPROUTE
 
 
 class CantGuessInterface(LookupError):
@@ -32,7 +74,7 @@ class NLA(Mapping):
     def get_attr(self, attr: str) -> Any: ...
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Interface:
     """A Linux interface"""
     # kernel interface index
@@ -53,7 +95,7 @@ class Interface:
 
 def iface_lookup(name: str) -> Interface:
     """Returns the first interface matching the given name"""
-    with IPRoute() as ipr:
+    with _ipr() as ipr:
         return Interface(
             name=name,
             index=ipr.link_lookup(ifname=name)[0]
@@ -62,7 +104,7 @@ def iface_lookup(name: str) -> Interface:
 
 def get_default_iface() -> Interface:
     """Returns the interface associated with the default route."""
-    with IPRoute() as ipr:
+    with _ipr() as ipr:
         default_routes: List[NLA] = ipr.get_default_routes(family=AddressFamily.AF_INET)
         if not default_routes:
             raise CantGuessInterface("No default IPv4 route")
@@ -70,97 +112,157 @@ def get_default_iface() -> Interface:
             raise CantGuessInterface("Too many default IPv4 routes")
         default_route = default_routes[0]
         iface_index: int = default_route.get_attr("RTA_OIF")
-        iface_info: NLA = ipr.link("get", index=iface_index)[0]
-    return Interface.from_netlink(iface_info)
+    # Only the name is missing from the route, no need for a whole netlink link request
+    return Interface(index=iface_index, name=if_indextoname(iface_index))
 
 
 def get_wired_iface() -> Interface:
     """Returns the first Ethernet interface found"""
-    with IPRoute() as ipr:
-        # TODO use correct constant for ethernet
-        ethernet: List[NLA] = [i for i in ipr.get_links() if i.get("ifi_type") == 1]
+    # The kernel can't filter link dumps by type, but there's no need to parse
+    # more than the two first ethernet interfaces to know if there are several.
+    # The dump is read lazily, on a dedicated socket since closing it is what
+    # discards the rest of the dump.
+    with IPRoute(nlm_generator=True) as ipr:
+        _force_buffers(ipr)
+        ethernet: List[NLA] = list(islice(
+            (i for i in ipr.link("dump") if i.get("ifi_type") == ARPHRD_ETHER), 2
+        ))
     if not ethernet:
         raise CantGuessInterface("No ethernet interface found")
     elif len(ethernet) > 1:
-        LOG.warning("%d ethernet interfaces found !", len(ethernet))
+        LOG.warning("Several ethernet interfaces found !")
         LOG.warning("selecting the first one, that might not be what you want")
     return Interface.from_netlink(ethernet[0])
 
 
-@contextmanager
+class _MakeBridge:
+    """The context manager returned by `make_bridge`"""
+
+    def __init__(self, addr: IPv4Address, prefixlen: int,
+                 for_iface: Optional[Interface], name: str) -> None:
+        self.addr = str(addr)
+        self.prefixlen = prefixlen
+        self.for_iface = for_iface
+        self.name = name
+        self.iface: Optional[Interface] = None
+
+    def __enter__(self) -> Interface:
+        with _ipr() as ipr:
+            # Bring it up in the same request that creates it
+            ipr.link("add", ifname=self.name, kind="bridge", state="up")
+            # The "add" acknowledgment doesn't carry the new index, look it up on the same socket
+            self.iface = iface = Interface(index=ipr.link_lookup(ifname=self.name)[0],
+                                           name=self.name)
+            try:
+                ipr.addr("add", index=iface.index, address=self.addr, prefixlen=self.prefixlen)
+                if self.for_iface:
+                    ipr.link("set", index=self.for_iface.index, master=iface.index)
+            except BaseException:
+                self.__exit__()
+                raise
+        return iface
+
+    def __exit__(self, *exc_info) -> None:
+        assert self.iface
+        with _ipr() as ipr:
+            ipr.link("del", index=self.iface.index)
+
+
 def make_bridge(addr: IPv4Address,
                 prefixlen: int,
                 for_iface: Optional[Interface] = None,
-                name: str = "autopxe-temp-br") -> Iterator[Interface]:
+                name: str = "autopxe-temp-br") -> _MakeBridge:
     """Context manager that creates & returns a bridge"""
-    with IPRoute() as ipr:
-        ipr.link("add", ifname=name, kind="bridge")
-        iface: Interface = iface_lookup(name)
-        ipr.addr("add", index=iface.index, address=str(addr), prefixlen=prefixlen)
-        ipr.link("set", index=iface.index, state="up")
-        if for_iface:
-            ipr.link("set", index=for_iface.index, master=iface.index)
-        yield iface
-        ipr.link("del", index=iface.index)
+    return _MakeBridge(addr, prefixlen, for_iface, name)
 
 
-@contextmanager
-def setup_iface(addr: IPv4Address, prefixlen: int, iface: Interface):
-    """Adds the given address to the interface. Also sets it up."""
-    with IPRoute() as ipr:
-        address_exists: bool = False
-        try:
-            LOG.info("Adding %s/%d to %s", addr, prefixlen, iface)
-            ipr.addr("add", index=iface.index, address=str(addr), prefixlen=prefixlen)
-        except NetlinkError as err:
-            if err.code == errno.EEXIST:
-                LOG.info("%s already has address %s/%d", iface, addr, prefixlen)
-                address_exists = True
-            else:
+class _SetupIface:
+    """The context manager returned by `setup_iface`"""
+
+    def __init__(self, addr: IPv4Address, prefixlen: int, iface: Interface) -> None:
+        # Formatted once for all the requests and messages below
+        self.addr = str(addr)
+        self.prefixlen = prefixlen
+        self.iface = iface
+        # Whether the address was already there, in which case it's left there
+        self.address_exists = False
+
+    def __enter__(self) -> None:
+        iface = self.iface
+        with _ipr() as ipr:
+            try:
+                LOG.info("Adding %s/%d to %s", self.addr, self.prefixlen, iface)
+                ipr.addr("add", index=iface.index, address=self.addr, prefixlen=self.prefixlen)
+            except NetlinkError as err:
+                if err.code == errno.EEXIST:
+                    LOG.info("%s already has address %s/%d", iface, self.addr, self.prefixlen)
+                    self.address_exists = True
+                else:
+                    raise
+            try:
+                ipr.link("set", index=iface.index, state="up")
+            except BaseException:
+                self.__exit__()
                 raise
-        ipr.link("set", index=iface.index, state="up")
-        LOG.info("%s is up", iface)
-        yield
-        if not address_exists:
-            LOG.info("Deleting %s/%d from %s", addr, prefixlen, iface)
-            ipr.addr("del", index=iface.index, address=str(addr), prefixlen=prefixlen)
+            LOG.info("%s is up", iface)
+
+    def __exit__(self, *exc_info) -> None:
+        if not self.address_exists:
+            LOG.info("Deleting %s/%d from %s", self.addr, self.prefixlen, self.iface)
+            with _ipr() as ipr:
+                ipr.addr("del", index=self.iface.index, address=self.addr,
+                         prefixlen=self.prefixlen)
+
+
+def setup_iface(addr: IPv4Address, prefixlen: int, iface: Interface) -> _SetupIface:
+    """Adds the given address to the interface. Also sets it up."""
+    return _SetupIface(addr, prefixlen, iface)
+
+
+@lru_cache(maxsize=32)
+def _oifname(name: str) -> Tuple[Any, ...]:
+    """nftables expressions that match packets going out of the given interface"""
+    encoded_name = name.encode("ascii")
+    if len(encoded_name) >= IFNAMSIZ:
+        raise ValueError(f"{name}: interface names are at most {IFNAMSIZ - 1} bytes long")
+    return (
+        expressions.genex("meta", {
+            "key": 7,  # NFT_META_OIFNAME
+            "dreg": 1,
+        }),
+        expressions.genex("cmp", {
+            "sreg": 1,
+            "op": 0,  # NFT_CMP_EQ
+            "data": {
+                "attrs": [("NFTA_DATA_VALUE", encoded_name.ljust(IFNAMSIZ, b"\x00"))],
+            },
+        }),
+    )
 
 
 @contextmanager
 def _masquerade():
     with NFTables(nfgen_family=0) as nft:
+        _force_buffers(nft)
         # if nft.get_rules():
         #   raise RuntimeError("nftables rules are present, we don't want to mess them up")
         FILT_TABLE = "autopxe-filter"
         NAT_TABLE = "autopxe-nat"
+        # Send everything in a single batch, committed atomically by the kernel.
+        # commit() writes the whole batch with one sendto() and asks for no acks.
+        nft.begin()
         nft.table("add", name=FILT_TABLE, nfgen_family=NFPROTO_INET)
         nft.table("add", name=NAT_TABLE, nfgen_family=NFPROTO_IPV4)
         # forward stuff
         # https://elixir.bootlin.com/linux/latest/source/net/netfilter/nf_tables_api.c
         nft.chain("add", table=FILT_TABLE, name="autopxe-forward",
                   hook="forward", type="filter", policy=1)
-
-        def oifname(name: str):
-            stuff = []
-            encoded_name: bytes = name.encode().ljust(16, b"\x00")
-            stuff.append(expressions.genex("meta", {
-                "key": 7,  # NFT_META_OIFNAME
-                "dreg": 1,
-            }))
-            stuff.append(expressions.genex("cmp", {
-                "sreg": 1,
-                "op": 0,  # NFT_CMP_EQ
-                "data": {
-                    "attrs": [("NFTA_DATA_VALUE", encoded_name)],
-                },
-            }))
-            return stuff
         nft.rule("add",
                  table=FILT_TABLE,
                  chain="autopxe-forward",
-                 expressions=(oifname("wlp61s0"),
+                 expressions=(_oifname("wlp61s0"),
                               expressions.verdict(1))
                  )
-        breakpoint()
-        pass
+        nft.commit()
+        # TODO NAT rules, remove everything on exit
         yield
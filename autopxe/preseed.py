@@ -1,55 +1,141 @@
-from functools import partial
-import http.server
-from ipaddress import IPv4Address
+import asyncio
 import logging
+import os
+from contextlib import suppress
+from ipaddress import IPv4Address
 from pathlib import Path
-from tempfile import TemporaryDirectory
 from threading import Thread
-from shutil import copyfile
-from typing import ClassVar, Optional
+from typing import BinaryIO, ClassVar, Optional, Set, Tuple
 
 LOG = logging.getLogger(__name__)
 
 
 class Preseeder:
-    """Copies a preseed configuration file to a temporary directory and serves it via http"""
+    """Serves a preseed configuration file via http"""
     FILE_NAME: ClassVar[str] = "preseed.cfg"
 
     def __init__(self, file_path: Optional[Path], server_ip: IPv4Address, port: int = 8000) -> None:
-        self._td = None
-        self._tempdir_name: Optional[Path] = None
         self.file_path = file_path
         self.server_addr = (str(server_ip), port)
+        # The event loop serving requests, run by server_thread
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # The clients currently connected
+        self._connections: Set[asyncio.StreamWriter] = set()
 
     @property
     def url(self) -> str:
         """The preseed file url for debian installer"""
-        ip, port = self.server.server_address
+        ip, port = self.server.sockets[0].getsockname()
         return f"http://{ip}:{port}/{self.FILE_NAME}"
 
-    @property
-    def temporary_directory_name(self) -> Path:
-        return self._tempdir_name
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, bool]]:
+        """Reads a request's method, path and whether to keep the connection alive.
 
-    def __enter__(self):
-        # TODO refactor, that's dirty
-        self._td = TemporaryDirectory("preseed")
-        self._tempdir_name = Path(self._td.__enter__())
-        handler_cls = partial(http.server.SimpleHTTPRequestHandler,
-                              directory=self.temporary_directory_name)
-        self.server = http.server.ThreadingHTTPServer(
-            server_address=self.server_addr,
-            RequestHandlerClass=handler_cls,
+        Returns `None` when the client closed the connection.
+        """
+        if not (request_line := await reader.readline()):
+            return None
+        method, path, version = request_line.decode(errors="replace").split()
+        keep_alive = version == "HTTP/1.1"
+        content_length = 0
+        while header := (await reader.readline()).strip():
+            name, _, value = header.decode(errors="replace").partition(":")
+            name, value = name.strip().lower(), value.strip().lower()
+            if name == "connection":
+                keep_alive = value == "keep-alive"
+            elif name == "content-length":
+                content_length = int(value)
+            elif name == "transfer-encoding":
+                # Its body can't be skipped without decoding it, so where it ends is unknown
+                keep_alive = False
+        # Skip the body, so that it isn't taken for the next request
+        await reader.readexactly(content_length)
+        return method, path, keep_alive
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: str, keep_alive: bool,
+                       body: Optional[BinaryIO] = None, send_body: bool = True,
+                       headers: str = ""):
+        """Sends a response, with the contents of the `body` file if any.
+
+        `headers` are extra header lines, each ending with CRLF.
+        """
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain\r\n"
+            f"Content-Length: {os.fstat(body.fileno()).st_size if body else 0}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"{headers}"
+            f"\r\n".encode()
         )
-        self.server_thread = Thread(target=self.server.serve_forever)
-        if self.file_path:
-            copyfile(self.file_path, self.temporary_directory_name / self.FILE_NAME)
-            LOG.info("Preseed configuration copied to %s", self.temporary_directory_name)
+        await writer.drain()
+        if body and send_body:
+            # Uses sendfile(), the contents don't go through userspace
+            await asyncio.get_running_loop().sendfile(writer.transport, body)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the preseed file to a client. Anything else is a 404."""
+        self._connections.add(writer)
+        try:
+            while request := await self._read_request(reader):
+                method, path, keep_alive = request
+                if method not in ("GET", "HEAD"):
+                    # Whatever this client sends next can't be anything we'd serve
+                    keep_alive = False
+                    await self._respond(writer, status := "405 Method Not Allowed", keep_alive,
+                                        headers="Allow: GET, HEAD\r\n")
+                elif path == f"/{self.FILE_NAME}" and self.file_path:
+                    try:
+                        # Served straight from where it is, without copying it anywhere
+                        body = self.file_path.open("rb")
+                    except OSError as err:
+                        # It was there when we started, but got removed or renamed since
+                        LOG.error("Can't serve the preseed file: %s", err)
+                        keep_alive = False
+                        await self._respond(writer, status := "500 Internal Server Error",
+                                            keep_alive)
+                    else:
+                        with body:
+                            await self._respond(writer, status := "200 OK", keep_alive,
+                                                body=body, send_body=method == "GET")
+                else:
+                    await self._respond(writer, status := "404 Not Found", keep_alive)
+                LOG.info("%s %s %s: %s", writer.get_extra_info("peername")[0], method, path, status)
+                if not keep_alive:
+                    break
+        except ValueError as err:
+            LOG.warning("Bad preseed request: %s", err)
+            with suppress(ConnectionError):
+                await self._respond(writer, "400 Bad Request", keep_alive=False)
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            LOG.warning("Bad preseed request: %s", err)
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _shutdown(self):
+        """Stops serving and drops the connections that clients kept alive"""
+        self.server.close()
+        for connection in self._connections:
+            # Their handler sees the end of the stream and returns
+            connection.close()
+        await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()})
+        await self.server.wait_closed()
+
+    def __enter__(self):
+        if self.file_path and not self.file_path.is_file():
+            raise FileNotFoundError(f"{self.file_path}: no such preseed file")
+        # A single thread running an event loop serves all the clients
+        self._loop = loop = asyncio.new_event_loop()
+        self.server = loop.run_until_complete(asyncio.start_server(self._handle, *self.server_addr))
+        # Daemon so that it never keeps the process alive if we don't get to __exit__
+        self.server_thread = Thread(target=loop.run_forever, daemon=True)
         self.server_thread.start()
         LOG.info("Serving preseed config as %s", self.url)
         return self
 
     def __exit__(self, exc, value, tb):
-        self.server.shutdown()
+        loop = self._loop
+        loop.call_soon_threadsafe(loop.stop)
         self.server_thread.join()
-        self._td.__exit__(exc, value, tb)
+        loop.run_until_complete(self._shutdown())
+        loop.close()
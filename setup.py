@@ -5,17 +5,14 @@ from pathlib import Path
 import setuptools
 
 VERSION_FILE = Path(__file__).parent / "autopxe" / "VERSION"
+VERSION = VERSION_FILE.read_text().strip()
 
-try:
-    long_description = Path("README.md").read_text()  # TODO write readme
-except IOError:
-    long_description = (
-        "autopxe"
-    )
+README_FILE = Path("README.md")
+long_description = README_FILE.read_text() if README_FILE.is_file() else "autopxe"
 
 setuptools.setup(
     name="autopxe",
-    version=VERSION_FILE.read_text(),
+    version=VERSION,
     author="Étienne Noss",
     author_email="etienne.noss+pypi@gmail.com",
     description=__doc__,
@@ -23,16 +20,19 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/etene/autopxe",
     packages=["autopxe"],
+    python_requires=">=3.10",
     install_requires=["pyroute2==0.5.14"],
     entry_points="""
     [console_scripts]
     autopxe=autopxe.__main__:main
     """,
     classifiers=[
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         # TODO
     ],
     package_data={"autopxe": ["py.typed", "VERSION"]},
+    include_package_data=True,
+    zip_safe=False,
     # TODO: config file ?
 )